@@ -1,19 +1,27 @@
 import os
+import asyncio
 import datetime
 import uuid
-import json
 import logging
-import shutil
+import re
+import sys
+from collections import deque
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Optional, List, Dict, Any, Union
+from typing import Optional, List, Dict, Any, Union, Deque, Tuple
 
+import aiofiles
 import openai
+import orjson
+import redis.asyncio as aioredis
+from cachetools import LRUCache
 from dotenv import load_dotenv
 from fastapi import FastAPI, WebSocket, HTTPException, status
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse
 from starlette.websockets import WebSocketDisconnect, WebSocketState
 from pydantic import BaseModel, ValidationError
+from redis.exceptions import RedisError
 
 # --- Configuration & Initialization ---
 
@@ -38,17 +46,10 @@ if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY environment variable not set.")
 
 # Initialize OpenAI Client (Ensure API key is set before this)
-try:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    # Test connection (optional but recommended)
-    client.models.list() # Make a simple call to check credentials/connectivity
-    logger.info("OpenAI client initialized successfully.")
-except openai.AuthenticationError:
-     logger.error("FATAL: OpenAI Authentication Error. Check API key.")
-     raise
-except Exception as e:
-    logger.error(f"FATAL: Failed to initialize OpenAI client: {e}", exc_info=True)
-    raise
+# The async client lets streamed completions yield to the event loop between chunks,
+# so one session's response no longer blocks every other connection.
+# Credentials/connectivity are checked in the app lifespan (see below).
+client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 # Define models available for chat
 MODELS = {
@@ -60,13 +61,23 @@ MODELS = {
 }
 DEFAULT_MODEL = 'gpt-4.1-2025-04-14' # Or choose your preferred default
 
-# Context Window Limit (Characters)
-MAX_CONTEXT_CHARS = 300_000
+# Context Window Limit (Conversation Turns)
+# Only the last N user/assistant exchanges are sent to the API. The system prompt
+# stays at the front of every request so the provider's prompt cache can reuse it.
+MAX_CONTEXT_TURNS = 20
+
+# Streaming Configuration
+# OpenAI deltas are coalesced into fewer WebSocket frames: a buffered chunk is sent
+# once it reaches STREAM_FLUSH_CHARS characters or STREAM_FLUSH_INTERVAL seconds
+# have passed since the previous frame, whichever comes first.
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_INTERVAL = 0.015
 
 # Chat History Configuration
 CHAT_DIR = Path("chat_history") # <-- Renamed directory
 SAVED_CHATS_SUBDIR = "saved_chats"
 SAVED_CHATS_DIR = CHAT_DIR / SAVED_CHATS_SUBDIR # Path to the subdirectory
+HISTORY_CACHE_SIZE = 1024 # Max number of session histories kept in memory
 
 try:
     # Create both the main directory and the subdirectory
@@ -82,9 +93,53 @@ except OSError as e:
     logger.error(f"FATAL: Could not create or access chat directories '{CHAT_DIR}' or '{SAVED_CHATS_DIR}': {e}", exc_info=True)
     raise
 
-# Active WebSocket Connections (Consider alternatives like Redis for multi-worker setups)
+# Optional Redis backend for multi-worker setups (e.g. uvicorn --workers 4).
+# When REDIS_URL is set, live history is shared through Redis so a client can reconnect
+# to any worker; each worker's chat_history folder stays the durable backup.
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_HISTORY_TTL = 86400 # Seconds an idle session's history stays in Redis (re-seeded from disk after)
+redis_client: Optional[aioredis.Redis] = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+
+# Adds messages to a session's history list in one atomic step.
+# KEYS[1] = history list, ARGV[1] = TTL, ARGV[2] = mode, ARGV[3] = number of new messages,
+# ARGV[4..] = encoded messages; the new ones come last.
+# mode "append": only the new messages are passed; if the list is missing nothing is written
+#   and 0 is returned, so the caller retries in "seed" mode.
+# mode "seed": the full history is passed; a missing list is created from all of it, an
+#   existing one (another worker seeded it first) only gets the new messages.
+_ADD_HISTORY_LUA = """
+local first_new = #ARGV - tonumber(ARGV[3]) + 1
+local first = first_new
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if ARGV[2] ~= 'seed' then
+        return 0
+    end
+    first = 4
+end
+for i = first, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+add_history_script = redis_client.register_script(_ADD_HISTORY_LUA) if redis_client else None
+
+# Sessions whose Redis history may be missing a turn (an append failed); their list is
+# dropped at the next opportunity so it gets re-seeded from disk
+_stale_redis_histories: set = set()
+
+# Active WebSocket Connections on this worker
 active_connections: Dict[str, WebSocket] = {}
 
+# In-memory LRU of recent chat histories (session_id -> (file stamp, messages)). Disk stays
+# the durable store; the cache absorbs repeated loads such as client reconnects. The stamp is
+# the file's (st_mtime_ns, st_size) when the entry was made, so an entry is only served while
+# the file is unchanged - another worker appending to the session invalidates it.
+history_cache: LRUCache = LRUCache(maxsize=HISTORY_CACHE_SIZE)
+
 # --- Pydantic Models for Data Validation ---
 
 class ChatMessage(BaseModel):
@@ -102,43 +157,121 @@ class WebSocketResponse(BaseModel):
     messages: Optional[List[ChatMessage]] = None # For history
     detail: Optional[str] = None # For error messages
 
+# Response models for the JSON endpoints: with a response model set, FastAPI
+# serializes replies straight to JSON bytes via Pydantic
+class SessionCreatedResponse(BaseModel):
+    session_id: str
+
+class HistoryPathResponse(BaseModel):
+    path: str
+
+class SaveChatResponse(BaseModel):
+    message: str
+    filename: str
+
 # --- Utility Functions ---
 
+# Canonical lowercase UUID as produced by str(uuid.uuid4()) in create_session
+_UUID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+def _valid_session_id(session_id: str) -> bool:
+    """Checks session ID format without constructing a uuid.UUID object."""
+    return _UUID_RE.fullmatch(session_id) is not None
+
+def _history_file(session_id: str) -> Path:
+    """Path of a session's live history log (JSON Lines: one message object per line)."""
+    return CHAT_DIR / f"{session_id}.jsonl"
+
+def _encode_jsonl(messages: List[Dict[str, str]]) -> bytes:
+    return b"".join(orjson.dumps(msg) + b"\n" for msg in messages)
+
+def _file_stamp(file_path: Path) -> Optional[Tuple[int, int]]:
+    """Returns (st_mtime_ns, st_size) for cache validation, or None if the file can't be stat'ed."""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
 def save_chat_history(session_id: str, messages: List[Dict[str, str]]):
-    """Saves live chat messages to a JSON file with error handling."""
-    file_path = CHAT_DIR / f"{session_id}.json"
+    """Writes a session's full chat history as a fresh JSON Lines file, with error handling."""
+    file_path = _history_file(session_id)
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
-        logger.debug(f"Live chat history saved for session {session_id} in {CHAT_DIR}")
+        with open(file_path, "wb") as f:
+            f.write(_encode_jsonl(messages))
+        stamp = _file_stamp(file_path)
+        if stamp is not None:
+            history_cache[session_id] = (stamp, list(messages)) # Copy so later in-place edits by the caller don't leak in
+        logger.debug("Live chat history saved for session %s in %s", session_id, CHAT_DIR)
     except IOError as e:
         logger.error(f"Error saving chat history for session {session_id} to {file_path}: {e}", exc_info=True)
         # Decide if you want to raise an exception or just log
     except Exception as e:
         logger.error(f"Unexpected error saving chat history for session {session_id}: {e}", exc_info=True)
 
-def load_chat_history(session_id: str) -> List[Dict[str, str]]:
-    """Loads chat messages from a JSON file with error handling."""
-    file_path = CHAT_DIR / f"{session_id}.json"
-    if not file_path.exists():
+async def append_chat_history(session_id: str, new_messages: List[Dict[str, str]]):
+    """
+    Appends new messages to a session's JSON Lines history without rewriting it.
+
+    Each turn costs O(new messages) of disk I/O instead of re-serializing the whole
+    conversation. Writes go through aiofiles so the event loop isn't blocked on disk.
+    """
+    file_path = _history_file(session_id)
+    data = _encode_jsonl(new_messages)
+    cached = history_cache.pop(session_id, None)
+    try:
+        async with aiofiles.open(file_path, "ab") as f:
+            await f.write(data)
+        # Keep the cache entry only if the file grew by exactly this write, i.e. no other
+        # worker appended since the entry was made; otherwise the next load re-reads it
+        stamp = _file_stamp(file_path)
+        if cached is not None and stamp is not None and stamp[1] == cached[0][1] + len(data):
+            cached[1].extend(new_messages)
+            history_cache[session_id] = (stamp, cached[1])
+        logger.debug("Appended %d message(s) to chat history for session %s", len(new_messages), session_id)
+    except IOError as e:
+        logger.error(f"Error appending chat history for session {session_id} to {file_path}: {e}", exc_info=True)
+    except Exception as e:
+        logger.error(f"Unexpected error appending chat history for session {session_id}: {e}", exc_info=True)
+
+def read_chat_history_file(session_id: str) -> List[Dict[str, str]]:
+    """Parses a session's JSON Lines history file. I/O errors (including a missing file) are raised."""
+    file_path = _history_file(session_id)
+    history = []
+    with open(file_path, "rb") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                msg = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                msg = None
+            # Basic validation: Ensure each record is a dict with 'role' and 'content'.
+            # A bad line (e.g. a write torn by a crash) is skipped rather than losing the whole history.
+            if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
+                logger.error(f"Skipping invalid record on line {line_number} of chat history file for session {session_id}: {file_path}")
+                continue
+            history.append(msg)
+    return history
+
+def load_chat_history(session_id: str, use_cache: bool = True) -> List[Dict[str, str]]:
+    """Loads chat messages from the in-memory cache, falling back to the JSON Lines file."""
+    file_path = _history_file(session_id)
+    stamp = _file_stamp(file_path)
+    cached = history_cache.get(session_id) if use_cache else None
+    if cached is not None and cached[0] == stamp:
+        logger.debug("Chat history for session %s served from cache", session_id)
+        return list(cached[1]) # Callers mutate the returned list; keep the cached copy intact
+    if stamp is None:
         logger.warning(f"No live chat history found for session {session_id} in {CHAT_DIR}")
         return []
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            history = json.load(f)
-            # Basic validation: Ensure it's a list of dicts with 'role' and 'content'
-            if not isinstance(history, list) or not all(
-                isinstance(msg, dict) and 'role' in msg and 'content' in msg for msg in history
-            ):
-                logger.error(f"Invalid format in chat history file for session {session_id}: {file_path}")
-                # Corrupted file - perhaps rename it and return empty?
-                # backup_path = file_path.with_suffix(".json.corrupted")
-                # file_path.rename(backup_path)
-                # logger.info(f"Renamed corrupted history file to {backup_path}")
-                return [] # Return empty history to avoid crashing
-            logger.debug(f"Chat history loaded for session {session_id}")
-            return history
-    except (IOError, json.JSONDecodeError) as e:
+        # Stamped before reading: if the file changes mid-read the entry is already stale
+        history = read_chat_history_file(session_id)
+        logger.debug("Chat history loaded for session %s", session_id)
+        history_cache[session_id] = (stamp, list(history))
+        return history
+    except IOError as e:
         logger.error(f"Error loading live chat history for session {session_id} from {file_path}: {e}", exc_info=True)
         return [] # Return empty history on error
     except Exception as e:
@@ -146,89 +279,139 @@ def load_chat_history(session_id: str) -> List[Dict[str, str]]:
         return []
 
 
-async def send_ws_message(websocket: WebSocket, message: WebSocketResponse):
-    """Safely sends a message over WebSocket, handling potential disconnects."""
+def _redis_key(session_id: str, suffix: str) -> str:
+    return f"session:{session_id}:{suffix}"
+
+async def _drop_stale_redis_history(session_id: str):
+    """Deletes a session's Redis history if an earlier append to it failed."""
+    if session_id in _stale_redis_histories:
+        await redis_client.delete(_redis_key(session_id, "msgs"))
+        _stale_redis_histories.discard(session_id)
+
+async def load_session_history(session_id: str) -> List[Dict[str, str]]:
+    """
+    Loads the live history for a session.
+
+    Reads the shared Redis list when REDIS_URL is configured, seeding it from the
+    JSON file on first use. Without Redis this is just load_chat_history.
+    """
+    if redis_client is None:
+        return load_chat_history(session_id)
+    key = _redis_key(session_id, "msgs")
+    try:
+        await _drop_stale_redis_history(session_id)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.expire(key, SESSION_HISTORY_TTL) # An active session's history doesn't expire
+            raw_messages, _ = await pipe.execute()
+        if raw_messages:
+            logger.debug("Chat history for session %s loaded from Redis", session_id)
+            return [orjson.loads(raw) for raw in raw_messages]
+        # Nothing in Redis (expired or dropped list, or a session that predates Redis);
+        # seed it from the durable file. A brand-new session is seeded by its first turn.
+        history = load_chat_history(session_id)
+        if history:
+            await add_history_script(keys=[key], args=[SESSION_HISTORY_TTL, "seed", 0, *[orjson.dumps(msg) for msg in history]])
+        return history
+    except RedisError as e:
+        logger.error(f"Redis error loading history for session {session_id}, falling back to disk: {e}", exc_info=True)
+        return load_chat_history(session_id, use_cache=False)
+
+async def push_session_messages(session_id: str, *new_messages: Dict[str, str]):
+    """Appends messages to the shared Redis history (no-op without Redis)."""
+    if redis_client is None:
+        return
+    key = _redis_key(session_id, "msgs")
+    try:
+        await _drop_stale_redis_history(session_id)
+        encoded = [orjson.dumps(msg) for msg in new_messages]
+        if not await add_history_script(keys=[key], args=[SESSION_HISTORY_TTL, "append", len(encoded), *encoded]):
+            # The list is missing (new session, expired or dropped): create it from the full
+            # history, which the disk append before this call already extended with the new messages
+            history = load_chat_history(session_id)
+            if history[-len(new_messages):] != list(new_messages):
+                history.extend(new_messages) # The disk append failed; Redis still gets the turn
+            await add_history_script(keys=[key], args=[SESSION_HISTORY_TTL, "seed", len(encoded), *[orjson.dumps(msg) for msg in history]])
+    except RedisError as e:
+        logger.error(f"Redis error appending history for session {session_id}: {e}", exc_info=True)
+        # The list now lacks this turn; drop it so it is re-seeded from disk
+        _stale_redis_histories.add(session_id)
+        try:
+            await _drop_stale_redis_history(session_id)
+        except RedisError:
+            pass # Retried on the next load or append for this session
+
+# Every stream frame has the same shape, so only the content string needs encoding per token
+_STREAM_PREFIX = b'{"type":"stream","content":'
+_STREAM_SUFFIX = b'}'
+_STREAM_DONE_FRAME = orjson.dumps({"type": "stream", "content": "[DONE]"})
+
+
+def _stream_frame(content: str) -> bytes:
+    """Builds a 'stream' frame directly as JSON bytes, skipping Pydantic on the per-token path."""
+    return _STREAM_PREFIX + orjson.dumps(content) + _STREAM_SUFFIX
+
+
+def _error_frame(detail: str) -> bytes:
+    """Builds an 'error' frame directly as JSON bytes (same shape as WebSocketResponse(type="error"))."""
+    return orjson.dumps({"type": "error", "detail": detail})
+
+
+async def send_ws_frame(websocket: WebSocket, frame: bytes):
+    """Safely sends a pre-serialized JSON frame over WebSocket, handling potential disconnects."""
     try:
         if websocket.client_state == WebSocketState.CONNECTED:
-            await websocket.send_json(message.model_dump(exclude_none=True))
+            await websocket.send_bytes(frame)
     except WebSocketDisconnect:
-        logger.warning(f"Client disconnected before message could be sent: {message.type}")
+        logger.warning("Client disconnected before frame could be sent")
     except RuntimeError as e:
         # Handles sending on a closed connection sometimes raises RuntimeError
          if "Cannot call send" in str(e):
-             logger.warning(f"Attempted to send on closed/closing websocket: {message.type}")
+             logger.warning("Attempted to send on closed/closing websocket")
          else:
              logger.error(f"Runtime error sending WebSocket message: {e}", exc_info=True)
     except Exception as e:
         logger.error(f"Unexpected error sending WebSocket message: {e}", exc_info=True)
 
-# --- Utility Functions ---
-
-def _limit_context_by_chars(
-    system_prompt: str,
-    history: List[Dict[str, str]],
-    max_chars: int,
-    model_name: str = "gpt-4.1-turbo" # Pass model for potential future tokenization
-) -> List[Dict[str, str]]:
-    """
-    Limits the message history sent to the API based on character count.
-
-    Keeps the system prompt and trims oldest messages first until the total
-    character count is below the max_chars limit.
-
-    Args:
-        system_prompt: The system prompt content.
-        history: The list of user/assistant messages (dicts with 'role' and 'content').
-        max_chars: The maximum allowed character count for the context.
-        model_name: The target model name (future use for tokenization).
-
-    Returns:
-        A list of messages (including system prompt) ready to be sent to the API,
-        respecting the character limit.
-    """
-    system_message = {"role": "system", "content": system_prompt}
-    working_messages = [system_message] + history  # Start with system + full history
-
-    current_chars = len(system_prompt) + sum(len(msg.get("content", "")) for msg in history)
-
-    if current_chars <= max_chars:
-        logger.debug(f"Context within limit: {current_chars} chars. Sending full history.")
-        return working_messages # No trimming needed
-
-    logger.info(f"Context limit ({max_chars} chars) exceeded: {current_chars} chars. Trimming oldest messages.")
-
-    # Calculate chars to remove
-    chars_to_remove = current_chars - max_chars
-    removed_chars_count = 0
-    original_message_count = len(history)
-
-    # Trim oldest messages (index 1 is the oldest conversational message)
-    # Keep removing from the front of the conversational history (after system prompt)
-    while current_chars > max_chars and len(working_messages) > 1: # Always keep system prompt
-        removed_message = working_messages.pop(1) # Remove the oldest message after system prompt
-        removed_len = len(removed_message.get("content", ""))
-        current_chars -= removed_len
-        removed_chars_count += removed_len
-        logger.debug(f"Removed message (role: {removed_message.get('role', 'N/A')}, len: {removed_len}). Current chars: {current_chars}")
-
-    final_message_count = len(working_messages) - 1 # Exclude system prompt for count comparison
-    logger.info(
-        f"Context trimmed. Removed ~{removed_chars_count} chars. "
-        f"Final message count for API: {final_message_count} (originally {original_message_count}). "
-        f"Final char count for API: {current_chars}"
-    )
 
-    # Safety check: If even the system prompt + latest message exceed limit,
-    # this loop might empty history. The API might still fail, but we've tried.
-    if len(working_messages) <= 1 and current_chars > max_chars:
-         logger.warning(f"System prompt + latest message might still exceed limit ({current_chars} > {max_chars}). API call may fail.")
-
-    return working_messages
+async def send_ws_message(websocket: WebSocket, message: WebSocketResponse):
+    """Validates and sends a WebSocketResponse (used for history/full_message frames)."""
+    await send_ws_frame(websocket, orjson.dumps(message.model_dump(exclude_none=True)))
 
 
 # --- FastAPI Application Setup ---
 
-app = FastAPI(title="Robust OpenAI Chat Service", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Verifies the OpenAI client (and Redis, if configured) on startup and closes them on shutdown."""
+    try:
+        # Test connection (optional but recommended)
+        await client.models.list() # Make a simple call to check credentials/connectivity
+        logger.info("OpenAI client initialized successfully.")
+    except openai.AuthenticationError:
+         logger.error("FATAL: OpenAI Authentication Error. Check API key.")
+         raise
+    except Exception as e:
+        logger.error(f"FATAL: Failed to initialize OpenAI client: {e}", exc_info=True)
+        raise
+    if redis_client is not None:
+        try:
+            await redis_client.ping()
+            logger.info("Connected to Redis")
+        except RedisError as e:
+            logger.error(f"FATAL: Could not connect to Redis at REDIS_URL: {e}", exc_info=True)
+            raise
+    yield
+    await client.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+app = FastAPI(
+    title="Robust OpenAI Chat Service",
+    version="1.0.0",
+    lifespan=lifespan,
+)
 
 # Mount static files directory
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -244,7 +427,7 @@ async def get_chat_interface():
          raise HTTPException(status_code=500, detail="Chat interface file not found.")
     return FileResponse(html_file_path)
 
-@app.post("/create_session", status_code=status.HTTP_201_CREATED)
+@app.post("/create_session", status_code=status.HTTP_201_CREATED, response_model=SessionCreatedResponse)
 async def create_session():
     """Creates a new chat session ID and initializes history."""
     session_id = str(uuid.uuid4())
@@ -258,7 +441,7 @@ async def create_session():
         logger.error(f"Failed to initialize session {session_id} history: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Could not create chat session.")
 
-@app.get("/get_history_path", response_class=JSONResponse)
+@app.get("/get_history_path", response_model=HistoryPathResponse)
 async def get_history_folder_path():
     """Returns the absolute path of the chat history directory."""
     try:
@@ -271,25 +454,23 @@ async def get_history_folder_path():
         logger.error(f"Could not resolve chat history path: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Could not determine chat history path.")
 
-@app.post("/save_chat/{session_id}", status_code=status.HTTP_200_OK)
+@app.post("/save_chat/{session_id}", status_code=status.HTTP_200_OK, response_model=SaveChatResponse)
 async def save_chat_session_manually(session_id: str):
     """
     Saves a copy of the current chat history for the given session_id
-    to a new file with a timestamp.
+    to a new timestamped file, exported as a JSON array.
     """
     logger.info(f"Received request to save chat for session: {session_id}")
 
     # Validate session_id format (basic)
-    try:
-        uuid.UUID(session_id)
-    except ValueError:
+    if not _valid_session_id(session_id):
         logger.warning(f"Invalid session ID format for save request: {session_id}")
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid session ID format."
         )
 
-    original_file_path = CHAT_DIR / f"{session_id}.json"
+    original_file_path = _history_file(session_id)
 
     if not original_file_path.exists():
         logger.warning(f"Attempted to save non-existent chat history for session: {session_id} from {CHAT_DIR}")
@@ -305,8 +486,12 @@ async def save_chat_session_manually(session_id: str):
         new_filename = f"session_{session_id}_saved_{timestamp}.json"
         new_file_path = SAVED_CHATS_DIR / new_filename
 
-        # Copy the existing history file to the new timestamped file
-        shutil.copy2(original_file_path, new_file_path) # copy2 preserves metadata like modification time
+        # The live log is JSON Lines; export it as a regular JSON array for readers of saved chats.
+        # Read from disk (not the per-worker cache), which every worker keeps current;
+        # read errors propagate so they are reported below instead of exporting an empty chat.
+        messages = read_chat_history_file(session_id)
+        with open(new_file_path, "wb") as f:
+            f.write(orjson.dumps(messages, option=orjson.OPT_INDENT_2))
 
         logger.info(f"Successfully saved chat history for session {session_id} to {new_file_path} (in {SAVED_CHATS_SUBDIR})")
         return {"message": "Chat history saved successfully.", "filename": new_filename}
@@ -325,114 +510,135 @@ async def save_chat_session_manually(session_id: str):
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
     """Handles WebSocket connections for chat sessions."""
     # Validate session_id format (basic)
-    try:
-        uuid.UUID(session_id)
-    except ValueError:
+    if not _valid_session_id(session_id):
         logger.warning(f"Invalid session ID format received: {session_id}")
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
     await websocket.accept()
-    logger.info(f"WebSocket connection accepted for session: {session_id}")
+    logger.info("WebSocket connection accepted for session: %s", session_id)
     active_connections[session_id] = websocket
 
-    # Load existing history or start fresh
-    messages = load_chat_history(session_id)
+    # Load existing history or start fresh, keeping only a sliding window of the most
+    # recent turns (user + assistant message per turn); the full transcript lives on disk
+    context_window: Deque[Dict[str, str]] = deque(await load_session_history(session_id), maxlen=2 * MAX_CONTEXT_TURNS)
     # Optional: Send history to client on connect
-    # await send_ws_message(websocket, WebSocketResponse(type="history", messages=[ChatMessage(**msg) for msg in messages]))
+    # await send_ws_message(websocket, WebSocketResponse(type="history", messages=[ChatMessage(**msg) for msg in load_chat_history(session_id)]))
 
     try:
-        while True:
-            # Receive message from client
+        # Receive messages from client; iter_text() ends cleanly when the client disconnects
+        async for raw_data in websocket.iter_text():
             try:
-                raw_data = await websocket.receive_text()
-                data = json.loads(raw_data)
-                request_data = WebSocketRequest.model_validate(data)
-                logger.debug(f"Received message from {session_id}: {request_data.type}")
-
-            except WebSocketDisconnect:
-                logger.info(f"WebSocket disconnected for session {session_id} (client closed)")
-                break # Exit the loop cleanly
-            except json.JSONDecodeError:
-                logger.warning(f"Received invalid JSON from session {session_id}")
-                await send_ws_message(websocket, WebSocketResponse(type="error", detail="Invalid JSON format."))
-                continue # Wait for next message
+                # Parse and validate in a single pass (no intermediate dict)
+                request_data = WebSocketRequest.model_validate_json(raw_data)
+                logger.debug("Received message from %s: %s", session_id, request_data.type)
+
             except ValidationError as e:
-                logger.warning(f"Received invalid message structure from session {session_id}: {e}")
-                await send_ws_message(websocket, WebSocketResponse(type="error", detail=f"Invalid message structure: {e}"))
+                # model_validate_json reports malformed JSON as a 'json_invalid' error
+                if any(err["type"] == "json_invalid" for err in e.errors()):
+                    logger.warning(f"Received invalid JSON from session {session_id}")
+                    await send_ws_frame(websocket, _error_frame("Invalid JSON format."))
+                else:
+                    logger.warning(f"Received invalid message structure from session {session_id}: {e}")
+                    await send_ws_frame(websocket, _error_frame(f"Invalid message structure: {e}"))
                 continue # Wait for next message
-            except Exception as e: # Catch unexpected errors during receive/parse
+            except Exception as e: # Catch unexpected errors during parse
                  logger.error(f"Error receiving/parsing message from {session_id}: {e}", exc_info=True)
-                 await send_ws_message(websocket, WebSocketResponse(type="error", detail="Server error processing your request."))
+                 await send_ws_frame(websocket, _error_frame("Server error processing your request."))
                  break # Assume connection is unstable
 
             # Process based on message type
             if request_data.type == "chat_message" and request_data.content:
                 user_message_content = request_data.content
-                messages.append({"role": "user", "content": user_message_content})
+                # Joins the context window only with its reply (see Save History), so a failed
+                # turn leaves neither an unsaved user message nor two user messages in a row
+                user_message = {"role": "user", "content": user_message_content}
 
                 # Prepare messages for OpenAI API
                 # Define System prompt (customize System Instructions Here)
-                current_time = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S %Z")
+                # Minute granularity keeps the prompt prefix identical across turns so
+                # OpenAI's automatic prompt cache can hit; seconds would change it every call.
+                current_time = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M %Z")
                 system_prompt = f"You are a helpful assistant. The current date and time is: {current_time}."
 
                 # --- Limit Context Window ---
-                api_messages_to_send = _limit_context_by_chars(
-                    system_prompt=system_prompt,
-                    history=messages, # Send the full, up-to-date history
-                    max_chars=MAX_CONTEXT_CHARS,
-                    model_name=DEFAULT_MODEL
-                )
+                # The deque already holds only the last MAX_CONTEXT_TURNS turns
+                api_messages_to_send = [{"role": "system", "content": system_prompt}, *context_window, user_message]
                 # -----------------------------
 
-                # Construct the message list for the API
-                # Send system prompt + full history (adjust context window management for production)
-                api_messages = [{"role": "system", "content": system_prompt}] + messages
-
-                assistant_response_content = ""
+                response_parts: List[str] = [] # Joined once after streaming; avoids O(N^2) string growth
+                error_sent = False # Set when an error frame has already been sent for this turn
                 try:
-                    logger.info(f"Sending request to OpenAI for session {session_id} (model: {DEFAULT_MODEL}) with {len(api_messages_to_send)} messages ({sum(len(m['content']) for m in api_messages_to_send)} chars).")
-                    response_stream = client.chat.completions.create(
+                    logger.info("Sending request to OpenAI for session %s (model: %s) with %d messages (%d chars).", session_id, DEFAULT_MODEL, len(api_messages_to_send), sum(len(m['content']) for m in api_messages_to_send))
+                    response_stream = await client.chat.completions.create(
                         model=DEFAULT_MODEL,
-                        messages=api_messages,
+                        messages=api_messages_to_send,
                         stream=True
                     )
 
-                    # Stream response back to client
-                    for chunk in response_stream:
-                        # Check if content is present and not None
-                        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content is not None:
-                            chunk_content = chunk.choices[0].delta.content
-                            assistant_response_content += chunk_content
-                            # Send chunk to client
-                            await send_ws_message(websocket, WebSocketResponse(type="stream", content=chunk_content))
+                    # Stream response back to client, coalescing small deltas into larger frames
+                    loop = asyncio.get_running_loop()
+                    pending: List[str] = []
+                    pending_chars = 0
+                    last_flush = loop.time()
+                    try:
+                        async for chunk in response_stream:
+                            # Read the delta content once per chunk (each attribute hop goes through the SDK model)
+                            delta = chunk.choices[0].delta if chunk.choices else None
+                            chunk_content = delta.content if delta else None
+                            # Check if content is present and not None
+                            if chunk_content is not None:
+                                response_parts.append(chunk_content)
+                                pending.append(chunk_content)
+                                pending_chars += len(chunk_content)
+                                now = loop.time()
+                                if pending_chars >= STREAM_FLUSH_CHARS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                                    # Send buffered chunk to client
+                                    await send_ws_frame(websocket, _stream_frame("".join(pending)))
+                                    pending.clear()
+                                    pending_chars = 0
+                                    last_flush = now
+                    finally:
+                        # Flush whatever is still buffered, even if the stream failed midway,
+                        # so the client sees everything that is saved to history below
+                        if pending:
+                            await send_ws_frame(websocket, _stream_frame("".join(pending)))
 
                     # Send termination signal after stream
-                    await send_ws_message(websocket, WebSocketResponse(type="stream", content="[DONE]"))
-                    logger.info(f"Successfully streamed response for session {session_id}")
+                    await send_ws_frame(websocket, _STREAM_DONE_FRAME)
+                    logger.info("Successfully streamed response for session %s", session_id)
 
                 except openai.APIConnectionError as e:
                     logger.error(f"OpenAI API Connection Error for session {session_id}: {e}", exc_info=True)
-                    await send_ws_message(websocket, WebSocketResponse(type="error", detail="Could not connect to AI service."))
+                    error_sent = True
+                    await send_ws_frame(websocket, _error_frame("Could not connect to AI service."))
                 except openai.RateLimitError as e:
                      logger.warning(f"OpenAI Rate Limit Error for session {session_id}: {e}", exc_info=True)
-                     await send_ws_message(websocket, WebSocketResponse(type="error", detail="AI service is temporarily overloaded. Please try again later."))
+                     error_sent = True
+                     await send_ws_frame(websocket, _error_frame("AI service is temporarily overloaded. Please try again later."))
                 except openai.APIStatusError as e:
                      logger.error(f"OpenAI API Status Error for session {session_id}: Status={e.status_code} Response={e.response}", exc_info=True)
-                     await send_ws_message(websocket, WebSocketResponse(type="error", detail=f"AI service error (Status: {e.status_code}). Please try again."))
+                     error_sent = True
+                     await send_ws_frame(websocket, _error_frame(f"AI service error (Status: {e.status_code}). Please try again."))
                 except Exception as e: # Catch-all for other OpenAI or streaming errors
                     logger.error(f"Error during OpenAI call or streaming for session {session_id}: {e}", exc_info=True)
                     # Attempt to send error before potentially breaking
-                    await send_ws_message(websocket, WebSocketResponse(type="error", detail="An unexpected error occurred while communicating with the AI."))
+                    error_sent = True
+                    await send_ws_frame(websocket, _error_frame("An unexpected error occurred while communicating with the AI."))
                     # Depending on the error, you might want to break or continue
                     # break
 
+                assistant_response_content = "".join(response_parts)
+
                 # --- Save History ---
                 # Only append the assistant response if it was generated
                 if assistant_response_content:
-                     messages.append({"role": "assistant", "content": assistant_response_content})
-                     save_chat_history(session_id, messages) # Save history including the new exchange
-                elif not any(m['type'] == 'error' for m in [msg async for msg in websocket.iter_json()]): # Crude check if an error wasn't already sent
+                     assistant_message = {"role": "assistant", "content": assistant_response_content}
+                     context_window.append(user_message)
+                     context_window.append(assistant_message)
+                     await append_chat_history(session_id, [user_message, assistant_message]) # Persist only the new exchange
+                     await push_session_messages(session_id, user_message, assistant_message)
+                elif not error_sent:
                      # If response was empty and no stream error sent, maybe log or send a generic message?
                      logger.warning(f"OpenAI response was empty for session {session_id}")
                      # await send_ws_message(websocket, WebSocketResponse(type="full_message", role="assistant", content="I received your message but didn't have a response."))
@@ -440,28 +646,30 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
 
             else:
                 # Handle other message types or ignore
-                logger.debug(f"Received unhandled message type '{request_data.type}' or empty content from {session_id}")
+                logger.debug("Received unhandled message type '%s' or empty content from %s", request_data.type, session_id)
+        else:
+            # Loop ran to completion (no break), i.e. the client closed the connection
+            logger.info("WebSocket disconnected for session %s (client closed)", session_id)
 
 
     except WebSocketDisconnect:
-        # This catches disconnects that happen outside the explicit receive_text try-block
-        logger.info(f"WebSocket disconnected unexpectedly for session {session_id}")
+        # This catches disconnects that happen outside iter_text() (e.g. while sending)
+        logger.info("WebSocket disconnected unexpectedly for session %s", session_id)
     except Exception as e:
         # Catch-all for unexpected errors within the main loop
         logger.error(f"Unexpected error in WebSocket handler for session {session_id}: {e}", exc_info=True)
         # Try to inform the client before closing, if possible
-        await send_ws_message(websocket, WebSocketResponse(type="error", detail="A critical server error occurred. Connection closing."))
+        await send_ws_frame(websocket, _error_frame("A critical server error occurred. Connection closing."))
     finally:
         # --- Cleanup ---
-        logger.info(f"Cleaning up connection for session: {session_id}")
-        if session_id in active_connections:
-            del active_connections[session_id]
-            logger.debug(f"Removed session {session_id} from active connections.")
+        logger.info("Cleaning up connection for session: %s", session_id)
+        if active_connections.pop(session_id, None) is not None:
+            logger.debug("Removed session %s from active connections.", session_id)
         # Ensure WebSocket is closed, even if disconnect was already handled
         if websocket.client_state != WebSocketState.DISCONNECTED:
              try:
                  await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
-                 logger.info(f"WebSocket connection explicitly closed for session: {session_id}")
+                 logger.info("WebSocket connection explicitly closed for session: %s", session_id)
              except RuntimeError as e: # Handle cases where close is called on an already closing connection
                   if "Cannot call close" in str(e):
                       logger.warning(f"Attempted to close an already closing/closed websocket for session {session_id}")
@@ -477,5 +685,20 @@ if __name__ == "__main__":
     import uvicorn
     logger.info("Starting Uvicorn server...")
     # Use reload=True only for development
-    # For production, run via: uvicorn main:app --host 0.0.0.0 --port 8000 --workers 4 (adjust workers as needed)
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True) # Set reload=False for production
+    # For production, run via: uvicorn main:app --host 0.0.0.0 --port 8000 --workers 4 --loop uvloop --http httptools --ws-max-size 262144 --ws-per-message-deflate false (adjust workers as needed)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=False,
+        # uvloop and httptools ship with uvicorn[standard]; uvloop is not available on Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
+        # Inbound frames are short user prompts, so keep per-connection buffers small:
+        # cap frame size at 256 KiB and skip permessage-deflate (its zlib state costs
+        # far more memory than it saves on small JSON frames).
+        ws_max_size=262144,
+        ws_per_message_deflate=False,
+        ws_ping_interval=30,
+    )
@@ -1,25 +1,46 @@
 import os
-import datetime
+import sys
+import asyncio
+import time
 import uuid
-import json
-from typing import Optional, List, Dict, Any
+import aiofiles
+import msgpack
+import orjson
+import httpx
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional, List, Dict, Any, Tuple, Set
 from fastapi import FastAPI, WebSocket
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-from starlette.websockets import WebSocketDisconnect
+from fastapi.responses import Response
+from starlette.websockets import WebSocketDisconnect, WebSocketState
 import openai
 import uvicorn
-from pydantic import BaseModel
 from pathlib import Path
 
-# Initialize FastAPI app
-app = FastAPI()
-
 # Initialize OpenAI client
 openai.api_type = 'openai'
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-client = openai.OpenAI()
+# Shared connection pool for OpenAI requests: keep-alive and HTTP/2 multiplexing let
+# concurrent chat sessions reuse connections instead of paying a TLS handshake each time.
+# The read timeout stays long because o1 models can think for minutes before the first token.
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+    timeout=httpx.Timeout(600.0, connect=5.0),
+)
+
+# Async client so streaming a response doesn't block the event loop for other sessions
+client = openai.AsyncOpenAI(http_client=http_client)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await http_client.aclose()
+
+# Initialize FastAPI app
+app = FastAPI(lifespan=lifespan)
 
 # Define models
 MODELS = {
@@ -29,208 +50,178 @@ MODELS = {
     'gpt-4o-mini': 'gpt-4o-mini'
 }
 
-# Get the current date and time
-current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# Stream batching: flush buffered tokens once this many characters or seconds accumulate
+STREAM_FLUSH_CHARS = 48
+STREAM_FLUSH_SECONDS = 0.03
 
-# Create a directory for storing chat histories
-CHAT_DIR = Path("chat_histories")
-CHAT_DIR.mkdir(exist_ok=True)
+# Pre-serialized stream frames: the [DONE] marker never changes, and chunk frames only
+# need the content string encoded between a fixed prefix and closing brace
+DONE_FRAME = orjson.dumps({"type": "stream", "content": "[DONE]"})
+STREAM_KEY_PREFIX = b'{"type":"stream","content":'
 
-# Store active WebSocket connections
-active_connections: Dict[str, WebSocket] = {}
+# o1 models take no system role, so the system prompt is embedded in the user message.
+# Filled with %-interpolation: (current date and time, user message)
+PROMPT_TMPL = "<system_prompt>The current date and time is: %s</system_prompt>\n<context></context>\n<user_prompt>%s</user_prompt>"
 
-class ChatMessage(BaseModel):
-    role: str
-    content: str
+# Formatted local time, cached per wall-clock second: (second, formatted string)
+_ts_cache = (0, "")
 
-class ChatSession(BaseModel):
-    session_id: str
-    messages: List[ChatMessage]
-    system_prompt: str = "The current date and time is: {current_datetime}"
+def now_ts() -> str:
+    global _ts_cache
+    t = time.time()
+    sec = int(t)
+    if sec != _ts_cache[0]:
+        _ts_cache = (sec, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)))
+    return _ts_cache[1]
 
-class MessageRequest(BaseModel):
-    session_id: str
-    message: str
+# Get the current date and time
+current_time = now_ts()
 
-def save_chat_history(session_id: str, messages: List[Dict[str, str]]):
-    file_path = CHAT_DIR / f"{session_id}.json"
-    with open(file_path, "w") as f:
-        json.dump(messages, f)
+# Chat page, read once at startup and served as bytes (lives next to this file)
+INDEX_HTML = (Path(__file__).parent / "index.html").read_bytes()
 
-def load_chat_history(session_id: str) -> List[Dict[str, str]]:
-    file_path = CHAT_DIR / f"{session_id}.json"
-    if file_path.exists():
-        with open(file_path) as f:
-            return json.load(f)
-    return []
+# Create a directory for storing chat histories
+CHAT_DIR = Path("chat_histories")
+CHAT_DIR.mkdir(exist_ok=True)
 
-@app.get("/", response_class=HTMLResponse)
+# Per-session state, kept apart from the sockets: a lock that serializes turns when several
+# sockets share one session, and the set of those sockets. The record lives while any of them
+# is open. The history itself is not kept in memory: the o1 prompt only carries the current
+# message, so the log file is append-only from here.
+# Both this state and the cap below are per worker process. __main__ starts WEB_CONCURRENCY
+# workers (one per CPU by default), so turns from sockets of one session that land on
+# different workers are not serialized, and the total connection limit is
+# MAX_CONNECTIONS x workers. Set WEB_CONCURRENCY=1 where per-session ordering matters.
+sessions: Dict[str, Tuple[asyncio.Lock, Set[WebSocket]]] = {}
+
+# Every open WebSocket on this worker (-> its session id), least recently active first.
+# Capped at MAX_CONNECTIONS; on overflow the least recently active socket is closed.
+MAX_CONNECTIONS = 10_000
+active_connections: "OrderedDict[WebSocket, str]" = OrderedDict()
+
+# Chat histories are append-only logs of msgpack-framed message records, written for the
+# record (this app never reads them back). File access goes through aiofiles so disk I/O
+# doesn't block the event loop.
+
+async def save_chat_history(session_id: str, messages: List[Dict[str, str]]):
+    file_path = CHAT_DIR / f"{session_id}.msgpack"
+    async with aiofiles.open(file_path, "wb") as f:
+        await f.write(b"".join(msgpack.packb(message, use_bin_type=True) for message in messages))
+
+async def append_chat_history(session_id: str, *messages: Dict[str, str]):
+    # Opened per turn so idle connections don't each hold a file descriptor; the buffered
+    # handle writes the whole turn (retrying short writes) before it is closed
+    file_path = CHAT_DIR / f"{session_id}.msgpack"
+    async with aiofiles.open(file_path, "ab") as f:
+        await f.write(b"".join(msgpack.packb(message, use_bin_type=True) for message in messages))
+
+@app.get("/")
 async def get_chat_interface():
-    return """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>OpenAI Self-Evaluation with Streaming</title>
-        <style>
-            body { max-width: 60%; margin: 0 auto; padding: 20px; font-family: Arial, sans-serif; }
-            #chat-container { height: 1000px; overflow-y: auto; border: 1px solid #ccc; padding: 10px; margin-bottom: 20px; }
-            #message-input { width: 80%; padding: 10px; }
-            button { padding: 10px 20px; background: #007bff; color: white; border: none; cursor: pointer; }
-            .message { margin: 10px 0; padding: 10px; border-radius: 5px; }
-            .user { background: #e9ecef; }
-            .assistant { background: #f8f9fa; }
-        </style>
-    </head>
-    <body>
-        <h3>ChatGPT</h3>
-        <div id="chat-container"></div>
-        <div>
-            <input type="text" id="message-input" placeholder="Engage with the AI...">
-            <button onclick="sendMessage()">Send</button>
-        </div>
-        <script>
-            let sessionId = null;
-            let ws = null;
-
-            async function initializeChat() {
-                const response = await fetch('/create_session', { method: 'POST' });
-                const data = await response.json();
-                sessionId = data.session_id;
-                connectWebSocket();
-            }
-
-            function connectWebSocket() {
-                ws = new WebSocket(`ws://${window.location.host}/ws/${sessionId}`);
-        
-                ws.onopen = function() {
-                    console.log('WebSocket connection established');
-                };
-        
-                ws.onmessage = function(event) {
-                    const message = JSON.parse(event.data);
-                   if (message.type === "stream") {
-                        if (message.content === "[DONE]") {
-                           return;
-                        }
-                        appendStreamContent(message.content);
-                    }
-                };
-                        ws.onclose = function() {
-                    console.log('WebSocket connection closed');
-                    setTimeout(connectWebSocket, 1000);
-                };
-            }
-
-            function appendMessage(role, content) {
-                const chatContainer = document.getElementById('chat-container');
-                const messageDiv = document.createElement('div');
-                messageDiv.className = `message ${role}`;
-               messageDiv.textContent = content;
-               chatContainer.appendChild(messageDiv);
-                chatContainer.scrollTop = chatContainer.scrollHeight;
-            }
-
-            function appendStreamContent(content) {
-                const chatContainer = document.getElementById('chat-container');
-                let lastMessage = chatContainer.lastElementChild;
-        
-                if (!lastMessage || !lastMessage.classList.contains('assistant')) {
-                    lastMessage = document.createElement('div');
-                    lastMessage.className = 'message assistant';
-                    chatContainer.appendChild(lastMessage);
-                }
-        
-                lastMessage.textContent += content;
-                chatContainer.scrollTop = chatContainer.scrollHeight;
-            }
-
-            function sendMessage() {
-                const input = document.getElementById('message-input');
-                const message = input.value.trim();
-        
-                if (message && ws && ws.readyState === WebSocket.OPEN) {
-                    appendMessage('user', message);
-                    ws.send(JSON.stringify({
-                        message: message
-                    }));
-                   input.value = '';
-                }
-            }
-
-            document.getElementById('message-input').addEventListener('keypress', function(e) {
-                if (e.key === 'Enter') {
-                    sendMessage();
-                }
-            });
-
-            initializeChat();
-        </script>
-    </body>
-    </html>
-    """
+    return Response(INDEX_HTML, media_type="text/html", headers={"Cache-Control": "public, max-age=3600"})
 
 @app.post("/create_session")
 async def create_session():
     session_id = str(uuid.uuid4())
-    save_chat_history(session_id, [])
+    await save_chat_history(session_id, [])
     return {"session_id": session_id}
 
 @app.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
     await websocket.accept()
-    active_connections[session_id] = websocket
+    # No await between the lookup and the inserts, so sockets connecting to the same
+    # session at the same moment still end up sharing one record and lock
+    if session_id not in sessions:
+        sessions[session_id] = (asyncio.Lock(), set())
+    lock, session_sockets = sessions[session_id]
+    session_sockets.add(websocket)
+    active_connections[websocket] = session_id
+    stale_websockets = []
+    while len(active_connections) > MAX_CONNECTIONS:
+        stale_websocket, _ = active_connections.popitem(last=False)
+        stale_websockets.append(stale_websocket)
     
     try:
+        for stale_websocket in stale_websockets:
+            try:
+                await stale_websocket.close()
+            except Exception:
+                pass
+        
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
+            message_data = orjson.loads(data)
+            # Mark this socket as the most recently active (unless it was evicted meanwhile)
+            if websocket in active_connections:
+                active_connections.move_to_end(websocket)
             
-            messages = load_chat_history(session_id)
-            messages.append({"role": "user", "content": message_data['message']})
+            # Turns on the same session run one at a time so history stays in order
+            async with lock:
+                user_record = {"role": "user", "content": message_data['message']}
             
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                current_time = now_ts()
             
-            response = client.chat.completions.create(
-                model=MODELS['o1-preview'],
-                messages=[
-                    {
-                        "role": "user",
-                        "content": f"""<system_prompt>The current date and time is: {current_time}</system_prompt>
-<context></context>
-<user_prompt>{message_data['message']}</user_prompt>"""
-                    }
-                ],
-                stream=True
-            )
+                response = await client.chat.completions.create(
+                    model=MODELS['o1-preview'],
+                    messages=[{"role": "user", "content": PROMPT_TMPL % (current_time, user_record["content"])}],
+                    stream=True
+                )
             
-            assistant_message = ""
-            for chunk in response:
-                if chunk.choices[0].delta.content:
+                assistant_parts = []
+                pending = []
+                pending_len = 0
+                last_flush = time.monotonic()
+                async for chunk in response:
                     chunk_content = chunk.choices[0].delta.content
-                    assistant_message += chunk_content
-                    await websocket.send_json({
-                        "type": "stream",
-                        "content": chunk_content
-                    })
+                    if chunk_content:
+                        assistant_parts.append(chunk_content)
+                        pending.append(chunk_content)
+                        pending_len += len(chunk_content)
+                        if pending_len >= STREAM_FLUSH_CHARS or time.monotonic() - last_flush > STREAM_FLUSH_SECONDS:
+                            await websocket.send_bytes(STREAM_KEY_PREFIX + orjson.dumps("".join(pending)) + b'}')
+                            pending = []
+                            pending_len = 0
+                            last_flush = time.monotonic()
+            
+                if pending:
+                    await websocket.send_bytes(STREAM_KEY_PREFIX + orjson.dumps("".join(pending)) + b'}')
             
-            await websocket.send_json({
-                "type": "stream",
-                "content": "[DONE]"
-            })
+                await websocket.send_bytes(DONE_FRAME)
             
-            messages.append({"role": "assistant", "content": assistant_message})
-            save_chat_history(session_id, messages)
+                assistant_record = {"role": "assistant", "content": "".join(assistant_parts)}
+                await append_chat_history(session_id, user_record, assistant_record)
             
     except WebSocketDisconnect:
-        del active_connections[session_id]
+        pass
     except Exception as e:
         print(f"Error in WebSocket connection: {str(e)}")
-        try:
-            del active_connections[session_id]
-            await websocket.close()
-        except:
-            pass
+    finally:
+        # pop() tolerates the entry already being gone (evicted); the session record is
+        # dropped only once its last socket has closed
+        active_connections.pop(websocket, None)
+        session_sockets.discard(websocket)
+        if not session_sockets:
+            del sessions[session_id]
+        if websocket.client_state == WebSocketState.CONNECTED:
+            try:
+                await websocket.close()
+            except Exception:
+                pass
 
 if __name__ == "__main__":
-    # Run the server with host set to "0.0.0.0" to make it externally accessible
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Run the server with host set to "0.0.0.0" to make it externally accessible.
+    # WEB_CONCURRENCY sets the number of worker processes (defaults to one per CPU core);
+    # set it explicitly in containers, where the visible core count may exceed the CPU quota.
+    # uvloop and httptools come with uvicorn[standard]; uvloop is not available on Windows.
+    uvicorn.run(
+        "chatstreamai:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
+        # o1 answers are long, token-dense text streamed in batched frames, so
+        # permessage-deflate pays for its CPU in bandwidth (mostly on mobile clients)
+        ws_per_message_deflate=True,
+        timeout_keep_alive=30,
+    )
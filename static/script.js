@@ -18,6 +18,7 @@ let ws = null;
 let reconnectAttempts = 0;
 const MAX_RECONNECT_ATTEMPTS = 5;
 const RECONNECT_DELAY_MS = 2000;
+const textDecoder = new TextDecoder(); // Server sends JSON frames as UTF-8 bytes
 
 // --- Initialization ---
 window.onload = initializeChat;
@@ -62,6 +63,7 @@ function connectWebSocket() {
     const wsUrl = `${wsProtocol}//${window.location.host}/ws/${sessionId}`;
     console.log("Connecting to WebSocket:", wsUrl);
     ws = new WebSocket(wsUrl);
+    ws.binaryType = 'arraybuffer';
 
     ws.onopen = function() {
         console.log('WebSocket connection established');
@@ -74,7 +76,8 @@ function connectWebSocket() {
         let message; // Declare message variable here
         console.debug("Raw WS message received:", event.data); // Log raw data
         try {
-            message = JSON.parse(event.data); // Parse here
+            const rawData = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data);
+            message = JSON.parse(rawData); // Parse here
             handleWebSocketMessage(message); // Pass parsed message
         } catch (error) {
             // Handle JSON parsing error separately